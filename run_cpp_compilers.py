@@ -1,13 +1,41 @@
+import hashlib
 import os
 import re
+import shutil
 import subprocess
 import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import NamedTuple
 
+_FUNC_HDR_RE = re.compile('(.*):\\s*$')
+_FUNC_SIGNATURE_RE = re.compile('(\\S+)\\s+\\(.*\\)$')
+
+# Operations whose operand is a byte offset within the same function, which get replaced by labels.
+_JUMP_OPS = frozenset({
+	'jmp',
+	'ja', 'jae', 'jb', 'jbe', 'jc', 'je', 'jg', 'jge', 'jl', 'jle', 'jo', 'jp', 'jpe', 'jpo', 'js', 'jz',
+	'jna', 'jnae', 'jnb', 'jnbe', 'jnc', 'jne', 'jng', 'jnge', 'jnl', 'jnle', 'jno', 'jnp', 'jns', 'jnz',
+	'jcxz', 'jecxz', 'jrcxz',
+	'loop', 'loope', 'loopne', 'loopz', 'loopnz',
+})
+
+_format_instruction_line = '  %-12s%s\n'.__mod__
+
+_COMPILER_EXE = {'msvc': 'cl', 'clang': 'clang++', 'gcc': 'g++'}
+
+_DISK_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'run_cpp_compilers_cache')
+_DISK_CACHE_MAX_FILES = 256
+
+# Environment variables that MSVC reads extra command-line options from. Include path variables
+# don't need to be listed, since their effect shows up in the preprocessed source.
+_COMPILER_ENVIRONMENT_VARIABLES = ('CL', '_CL_')
+
 class FunctionDefinition(NamedTuple):
 	name: str
-	line_start_index: int
-	line_count: int
+	instructions: list
+	source_index: int
 
 class Instruction(NamedTuple):
 	byte_offset: str
@@ -24,141 +52,141 @@ class CleanedFunction(NamedTuple):
 	instructions: list
 
 def parse_instruction(line):
-	m = re.search('^\\s*(\\S+):\\s+(\\S+)\\s*(.*?)$', line)
-	if (m):
-		return Instruction(m.group(1), m.group(2), m.group(3))
-	else:
+	# Instruction lines look like '  0000000000000000: mov         eax,1'. Function headers and
+	# the other lines that end a function definition are flush-left, so reject those without splitting.
+	if (not line[:1].isspace()):
+		return None
+	parts = line.split(None, 2)
+	if (len(parts) < 2 or not parts[0].endswith(':')):
 		return None
+	operands = parts[2].rstrip('\n') if len(parts) == 3 else ''
+	return Instruction(parts[0][:-1], parts[1], operands)
 
 def get_function_definitions(lines):
 	# Scan through the 'dumpbin' output and identify function definitions.
+	# 'lines' can be any iterable of lines, such as a pipe from the 'dumpbin' process.
 	definitions = []
-	line_index = 0
-
-	while (line_index < len(lines)):
-		m1 = re.search('^(.*):\\s*$', lines[line_index])
+	short_name = None
+	instructions = None
+
+	for line in lines:
+		if (short_name != None):
+			instruction = parse_instruction(line)
+			if (instruction != None):
+				instructions.append(instruction)
+			else:
+				# We've reached the end of the function definition.
+				definitions.append(FunctionDefinition(short_name, instructions, len(definitions)))
+				short_name = None
+			continue
+
+		m1 = _FUNC_HDR_RE.match(line)
 		if (m1):
 			# We're in a function definition.
 			function_name = m1.group(1)
 			short_name = function_name
 
-			m2 = re.search('^(\\S+)\\s+\\(.*\\)$', function_name)
+			m2 = _FUNC_SIGNATURE_RE.match(function_name)
 			if (m2):
 				short_name = m2.group(1)
 
-			line_start_index = line_index;
-			line_index += 1
-
-			while (line_index < len(lines)):
-				if (parse_instruction(lines[line_index]) == None):
-					# We've reached the end of the function definition.
-					line_count = line_index - line_start_index
-					definitions.append(FunctionDefinition(short_name, line_start_index, line_count))
-					break;
-				line_index += 1
-
-		line_index += 1
-
-	return definitions
-
-def find_function_definition(function_definitions, name):
-	return next((definition for definition in function_definitions if definition.name == name), None)
-
-def get_used_functions(lines, function_definitions, used_functions, current_function_names):
-	for current_function_name in current_function_names:
-		if (find_function_definition(used_functions, current_function_name)):
-			return
-		d = find_function_definition(function_definitions, current_function_name)
-		if (d):
-			used_functions.append(d)
-			for line_index in range(d.line_start_index + 1, d.line_start_index + d.line_count):
-				instruction = parse_instruction(lines[line_index])
-				if (instruction.operation == 'call'):
-					get_used_functions(lines, function_definitions, used_functions, [instruction.operands])
-
-def is_jump(operation):
-	return operation.startswith('j')
-
-def get_cleaned_function(lines, function, next_label_index):
-	instruction_pairs = []
-	for line_index in range(function.line_start_index + 1, function.line_start_index + function.line_count):
-		instruction = parse_instruction(lines[line_index])
-		cleaned_instruction = CleanedInstruction(None, instruction.operation, instruction.operands)
-		instruction_pairs.append((instruction, cleaned_instruction))
-	for index in range(len(instruction_pairs)):
-		raw_instruction = instruction_pairs[index][0]
-		if (is_jump(raw_instruction.operation)):
-			target_byte_offset = raw_instruction.operands
-			target_instruction_index = None
-			for target_index in range(len(instruction_pairs)):
-				raw_target_instruction = instruction_pairs[target_index][0]
-				if (raw_target_instruction.byte_offset == target_byte_offset):
-					old_cleaned_instruction = instruction_pairs[index][1]
-					old_cleaned_target_instruction = instruction_pairs[target_index][1]
-
-					if (old_cleaned_target_instruction.label != None):
-						label = old_cleaned_target_instruction.label
-						new_cleaned_target_instruction = old_cleaned_target_instruction
-					else:
-						label = f'$L{next_label_index}'
-						next_label_index += 1
-						new_cleaned_target_instruction = CleanedInstruction(label, old_cleaned_target_instruction.operation, old_cleaned_target_instruction.operands)
-					
-					new_cleaned_instruction = CleanedInstruction(old_cleaned_instruction.label, old_cleaned_instruction.operation, label)
-					
-					instruction_pairs[index] = (raw_instruction, new_cleaned_instruction)
-					instruction_pairs[target_index] = (raw_target_instruction, new_cleaned_target_instruction)
-
-					break
-	cleaned_instructions = map(lambda pair: pair[1], instruction_pairs)
-	return CleanedFunction(function.name, cleaned_instructions);
-
-def get_cleaned_functions(lines, function_definitions, used_functions):
+			instructions = []
+
+	# Names can repeat (e.g. COMDAT duplicates); the first definition wins.
+	definitions_by_name = {}
+	for definition in definitions:
+		definitions_by_name.setdefault(definition.name, definition)
+	return definitions_by_name
+
+def find_function_definition(definitions_by_name, name):
+	return definitions_by_name.get(name)
+
+def get_used_functions(definitions_by_name, root_function_names):
+	# Walk the call graph from the root functions, using an explicit queue rather than recursion.
+	used_functions = []
+	used_function_names = set()
+	pending_function_names = deque(root_function_names)
+
+	while (pending_function_names):
+		function_name = pending_function_names.popleft()
+		if (function_name in used_function_names):
+			continue
+		d = find_function_definition(definitions_by_name, function_name)
+		if (not d):
+			continue
+		used_functions.append(d)
+		used_function_names.add(function_name)
+		for instruction in d.instructions:
+			if (instruction.operation == 'call'):
+				pending_function_names.append(instruction.operands)
+
+	return used_functions
+
+def get_cleaned_function(function, next_label_index):
+	# Cleaned instructions are kept as mutable [label, operation, operands] lists, parallel to the
+	# raw instructions, while jump labels are patched in.
+	raw_instructions = function.instructions
+	cleaned_instructions = []
+	offset_to_index = {}
+	jump_indices = []
+	for index, instruction in enumerate(raw_instructions):
+		cleaned_instructions.append([None, instruction.operation, instruction.operands])
+		offset_to_index[instruction.byte_offset] = index
+		if (instruction.operation in _JUMP_OPS):
+			jump_indices.append(index)
+
+	# Jump targets can only be resolved once every offset has been seen. Patching the jumps in
+	# source order keeps the label numbering stable.
+	for index in jump_indices:
+		target_index = offset_to_index.get(raw_instructions[index].operands)
+		if (target_index != None):
+			cleaned_target_instruction = cleaned_instructions[target_index]
+			label = cleaned_target_instruction[0]
+			if (label == None):
+				label = f'$L{next_label_index}'
+				next_label_index += 1
+				cleaned_target_instruction[0] = label
+			cleaned_instructions[index][2] = label
+	cleaned_function = CleanedFunction(function.name, [CleanedInstruction(*instruction) for instruction in cleaned_instructions])
+	return cleaned_function, next_label_index
+
+def get_cleaned_functions(used_functions):
 	next_label_index = 0
 	cleaned_functions = []
 
-	for functionDefinition in function_definitions:
-		function = find_function_definition(used_functions, functionDefinition.name)
-		if (function):
-			cleaned_functions.append(get_cleaned_function(lines, function, next_label_index))
+	# Emit the functions in the order they appear in the 'dumpbin' output.
+	for function in sorted(used_functions, key=lambda d: d.source_index):
+		cleaned_function, next_label_index = get_cleaned_function(function, next_label_index)
+		cleaned_functions.append(cleaned_function)
 	return cleaned_functions
 
-def write_cleaned_function(output_file, cleaned_function):
-	output_file.write(f'{cleaned_function.name}:\n')
+def format_cleaned_function(cleaned_function):
+	text = [f'{cleaned_function.name}:\n']
 	for instruction in cleaned_function.instructions:
 		if (instruction.label):
-			output_file.write(f'{instruction.label}:\n')
-		output_file.write(f'  {instruction.operation}')
-		for index in range(12 - len(instruction.operation)):
-			output_file.write(' ')
-		output_file.write(f'{instruction.operands}\n')
-	output_file.write('\n')
+			text.append(f'{instruction.label}:\n')
+		text.append(_format_instruction_line((instruction.operation, instruction.operands)))
+	text.append('\n')
+	return ''.join(text)
 
 def file_name_without_extension(file_name):
 	return os.path.splitext(os.path.basename(file_name))[0]
 
 def write_cleaned_disasm(output_file, lines, root_function_names):
-	definitions = get_function_definitions(lines)
-	used_functions = []
-	get_used_functions(lines, definitions, used_functions, root_function_names)
-	cleaned_functions = get_cleaned_functions(lines, definitions, used_functions)
-	for cleaned_function in cleaned_functions:
-		write_cleaned_function(output_file, cleaned_function)
+	definitions_by_name = get_function_definitions(lines)
+	used_functions = get_used_functions(definitions_by_name, root_function_names)
+	cleaned_functions = get_cleaned_functions(used_functions)
+	output_file.write(''.join(format_cleaned_function(cleaned_function) for cleaned_function in cleaned_functions))
 
 def print_command(cmd_parts):
-	for cmd_part in cmd_parts:
-		print(cmd_part, end=' ')
-	print('')
+	# One print call per command, so lines from jobs running on other threads don't interleave.
+	print(' '.join(cmd_parts))
 
 def compiler_exe_name(compiler_name):
-	if (compiler_name == 'msvc'):
-		return 'cl'
-	elif (compiler_name == 'clang'):
-		return 'clang++'
-	elif (compiler_name == 'gcc'):
-		return 'g++'
-	else:
+	exe_name = _COMPILER_EXE.get(compiler_name)
+	if (exe_name == None):
 		raise Exception(f'Unknown compiler name: {compiler_name}')
+	return exe_name
 
 def version_option(compiler_name):
 	if (compiler_name == 'msvc'):
@@ -166,11 +194,11 @@ def version_option(compiler_name):
 	else:
 		return '-v'
 
-def output_file_options(compiler_name, obj_dir, obj_file_name):
+def output_file_options(compiler_name, obj_dir, obj_path):
 	if (compiler_name == 'msvc'):
-		return [f'/Fo{obj_dir}\\']
+		return [f'/Fo{obj_dir}{os.sep}']
 	else:
-		return ['-o', f'{obj_dir}\\{obj_file_name}']
+		return ['-o', obj_path]
 
 def write_compiler_version(compiler_name, cleaned_disasm):
 	cmd_parts = [compiler_exe_name(compiler_name)]
@@ -179,54 +207,123 @@ def write_compiler_version(compiler_name, cleaned_disasm):
 		cmd_parts.append(option)
 
 	print_command(cmd_parts)
+	# The compiler writes straight to the file descriptor, so nothing may be left in our buffer.
+	cleaned_disasm.flush()
 	result = subprocess.run(cmd_parts, stdout=cleaned_disasm, stderr=cleaned_disasm)
 	if (result.returncode != 0):
-		print(f'Unable to determine compiler version for {compiler_name}')
+		print(f'Unable to determine compiler version for {compiler_name}: {cleaned_disasm.name}')
+		return False
 	else:
 		cleaned_disasm.write('\n')
+		return True
 
-def generate_disassembly(compiler_name, cpp_file_name, disasm_file_name, include_directories, pound_defines, additional_compiler_options, root_function_names):
-	cleaned_disasm = open(disasm_file_name, 'w')
-
-	write_compiler_version(compiler_name, cleaned_disasm)
-
-	cpp_file_nameWithoutExtension = file_name_without_extension(cpp_file_name)
-	obj_file_name = f'{cpp_file_nameWithoutExtension}.obj'
+def executable_identity(exe_name):
+	exe_path = shutil.which(exe_name)
+	return (exe_path, os.stat(exe_path).st_mtime_ns if exe_path else None)
 
-	with tempfile.TemporaryDirectory() as obj_dir:
-		cmd_parts = [compiler_exe_name(compiler_name)]
-		cmd_parts += additional_compiler_options
-
-		for include_directory in include_directories:
-			cmd_parts.append('-I')
-			cmd_parts.append(include_directory)
+def compiler_cmd_parts(compiler_name, cpp_file_name, include_directories, pound_defines, additional_compiler_options, mode_options):
+	cmd_parts = [compiler_exe_name(compiler_name)]
+	cmd_parts += additional_compiler_options
 
-		for pound_define in pound_defines:
-			cmd_parts.append('-D')
-			cmd_parts.append(pound_define)
+	for include_directory in include_directories:
+		cmd_parts.append('-I')
+		cmd_parts.append(include_directory)
 
-		for output_fileOption in output_file_options(compiler_name, obj_dir, obj_file_name):
-			cmd_parts.append(output_fileOption)
+	for pound_define in pound_defines:
+		cmd_parts.append('-D')
+		cmd_parts.append(pound_define)
 
-		cmd_parts.append('-c')
+	cmd_parts += mode_options
 
-		cmd_parts.append(cpp_file_name)
+	cmd_parts.append(cpp_file_name)
+	return cmd_parts
 
-		print_command(cmd_parts)
-		compiler_result = subprocess.run(cmd_parts, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-		if (compiler_result.returncode != 0):
-			print("!!!!!!!!!!!!!!")
-			print('COMPILE ERRORS')
-			print("!!!!!!!!!!!!!!")
+def disassembly_cache_key(compiler_name, cpp_file_name, include_directories, pound_defines, additional_compiler_options, root_function_names):
+	# The key covers everything that can change the cleaned disassembly: the preprocessed source (so
+	# every header the compiler actually reads is included, wherever it lives), the options, the
+	# compiler and dumpbin binaries, and the compiler's environment.
+	# Returns None if preprocessing fails, leaving the normal compile to report the problem.
+	cmd_parts = compiler_cmd_parts(compiler_name, cpp_file_name, include_directories, pound_defines, additional_compiler_options, ['-E'])
+	print_command(cmd_parts)
+	preprocessor_result = subprocess.run(cmd_parts, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	if (preprocessor_result.returncode != 0):
+		return None
 
-		with tempfile.TemporaryFile('r') as disasm:
-			dumpbin_cmd_parts = ['dumpbin', '/disasm:nobytes', f'{obj_dir}/{obj_file_name}']
+	key = hashlib.blake2b(preprocessor_result.stdout)
+	environment = [(name, os.environ.get(name)) for name in _COMPILER_ENVIRONMENT_VARIABLES]
+
+	key.update(repr((
+		compiler_name,
+		executable_identity(compiler_exe_name(compiler_name)),
+		executable_identity('dumpbin'),
+		environment,
+		pound_defines,
+		additional_compiler_options,
+		root_function_names)).encode())
+	return key.hexdigest()
+
+def prune_disk_cache():
+	# Keep only the most recently used cache entries. Other jobs may be pruning at the same time.
+	entries = []
+	for entry in os.scandir(_DISK_CACHE_DIR):
+		if (entry.name.endswith('.asm')):
+			try:
+				entries.append((entry.stat().st_mtime_ns, entry.path))
+			except FileNotFoundError:
+				pass
+	entries.sort(reverse=True)
+	for mtime, path in entries[_DISK_CACHE_MAX_FILES:]:
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+def generate_disassembly(compiler_name, cpp_file_name, disasm_file_name, include_directories, pound_defines, additional_compiler_options, root_function_names, use_cache=False):
+	cached_disasm_file_name = None
+	if (use_cache):
+		cache_key = disassembly_cache_key(compiler_name, cpp_file_name, include_directories, pound_defines, additional_compiler_options, root_function_names)
+		if (cache_key):
+			cached_disasm_file_name = os.path.join(_DISK_CACHE_DIR, f'{cache_key}.asm')
+
+	if (cached_disasm_file_name and os.path.exists(cached_disasm_file_name)):
+		print(f'Using cached disassembly for {compiler_name}: {disasm_file_name}')
+		shutil.copy(cached_disasm_file_name, disasm_file_name)
+		# Mark the entry as recently used so pruning keeps it.
+		os.utime(cached_disasm_file_name)
+		return
+
+	with open(disasm_file_name, 'w', buffering=1<<20) as cleaned_disasm:
+		has_compiler_version = write_compiler_version(compiler_name, cleaned_disasm)
+
+		cpp_file_nameWithoutExtension = file_name_without_extension(cpp_file_name)
+		obj_file_name = f'{cpp_file_nameWithoutExtension}.obj'
+
+		with tempfile.TemporaryDirectory() as obj_dir:
+			obj_path = os.path.join(obj_dir, obj_file_name)
+			cmd_parts = compiler_cmd_parts(compiler_name, cpp_file_name, include_directories, pound_defines, additional_compiler_options, output_file_options(compiler_name, obj_dir, obj_path) + ['-c'])
+
+			print_command(cmd_parts)
+			compiler_result = subprocess.run(cmd_parts, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace')
+			if (compiler_result.returncode != 0):
+				# MSVC reports diagnostics on stdout, clang and gcc on stderr.
+				print(
+					'!!!!!!!!!!!!!!\n'
+					f'COMPILE ERRORS ({compiler_name}: {disasm_file_name})\n'
+					'!!!!!!!!!!!!!!\n'
+					f'{compiler_result.stdout}{compiler_result.stderr}', end='')
+
+			dumpbin_cmd_parts = ['dumpbin', '/disasm:nobytes', obj_path]
 			print_command(dumpbin_cmd_parts)
-			subprocess.run(dumpbin_cmd_parts, stdout=disasm)
+			with subprocess.Popen(dumpbin_cmd_parts, stdout=subprocess.PIPE, text=True, bufsize=1<<20) as dumpbin:
+				write_cleaned_disasm(output_file=cleaned_disasm, lines=dumpbin.stdout, root_function_names=root_function_names)
 
-			disasm.seek(0)
-			lines = disasm.readlines()
-			write_cleaned_disasm(output_file=cleaned_disasm, lines=lines, root_function_names=root_function_names)
+	if (cached_disasm_file_name and has_compiler_version and compiler_result.returncode == 0 and dumpbin.returncode == 0):
+		# Copy into the cache under a temporary name first so that a concurrent job never sees a partial file.
+		os.makedirs(_DISK_CACHE_DIR, exist_ok=True)
+		partial_cached_disasm_file_name = f'{cached_disasm_file_name}.{os.getpid()}.{threading.get_ident()}'
+		shutil.copy(disasm_file_name, partial_cached_disasm_file_name)
+		os.replace(partial_cached_disasm_file_name, cached_disasm_file_name)
+		prune_disk_cache()
 
 class CompilerConfig(NamedTuple):
 	compiler_name: str
@@ -237,17 +334,29 @@ class TestConfig(NamedTuple):
 	pound_defines: list
 	output_file_name_suffix: str
 
-def generate_disassembly_files(compiler_configs, cpp_file_name, include_directories, output_directory, test_configs):
+def generate_disassembly_batch(jobs):
+	# Each job is a tuple of generate_disassembly arguments. The compiler and dumpbin run as
+	# separate processes, so the jobs can be run in parallel on threads.
+	with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+		futures = [executor.submit(generate_disassembly, *job) for job in jobs]
+		for future in futures:
+			future.result()
+
+def generate_disassembly_files(compiler_configs, cpp_file_name, include_directories, output_directory, test_configs, use_cache=False):
+	jobs = []
 	for compiler_config in compiler_configs:
 		compiler_name = compiler_config.compiler_name
 		for test_config in test_configs:
 			disasm_file_name = os.path.join(output_directory, compiler_name + '-' + test_config.output_file_name_suffix)
 
-			generate_disassembly(
+			jobs.append((
 				compiler_name,
 				cpp_file_name,
 				disasm_file_name,
 				include_directories,
-				pound_defines=test_config.pound_defines,
-				additional_compiler_options=compiler_config.command_line_flags,
-				root_function_names=compiler_config.root_function_names)
\ No newline at end of file
+				test_config.pound_defines,
+				compiler_config.command_line_flags,
+				compiler_config.root_function_names,
+				use_cache))
+
+	generate_disassembly_batch(jobs)